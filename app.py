@@ -1,7 +1,13 @@
 # app.py
 
 import streamlit as st
-import json
+import orjson
+import hashlib
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import diskcache
 import google.generativeai as genai
 
 # --- Configuration and Initialization ---
@@ -16,39 +22,50 @@ st.set_page_config(
 # IMPORTANT: Use Streamlit's secrets management for the API key
 # Create a file .streamlit/secrets.toml and add your key there:
 # GEMINI_API_KEY = "YOUR_API_KEY_HERE"
+# genai.configure() throws away the SDK's cached clients, so it only runs once
+# per process; every request then reuses the same open gRPC channel instead of
+# paying for a new connection and TLS handshake on each rerun
+@st.cache_resource
+def configure_gemini(api_key: str) -> None:
+    """Configure the Gemini SDK with the given API key."""
+    genai.configure(api_key=api_key)
+
 try:
-    genai.configure(api_key=st.secrets["GEMINI_API_KEY"])
+    configure_gemini(st.secrets["GEMINI_API_KEY"])
 except (KeyError, AttributeError):
     st.error("🚨 Gemini API Key not found! Please add it to your Streamlit secrets.", icon="🚨")
     st.stop()
 
 
+# Build the model once per process and share it across reruns and sessions
+@st.cache_resource
+def get_model() -> genai.GenerativeModel:
+    """Return the shared Gemini model."""
+    return genai.GenerativeModel('gemini-1.5-flash')
+
 # Initialize the model (with error handling)
 try:
-    model = genai.GenerativeModel('gemini-1.5-flash')
+    model = get_model()
 except Exception as e:
     st.error(f"Error initializing the model: {e}")
     model = None # Set model to None if initialization fails
 
 # --- Data and Constants ---
 
+# Tuples so the widgets get the same immutable options on every rerun
 SUBJECTS = {
-    "Math": ["Algebra", "Geometry", "Calculus", "Statistics", "Trigonometry"],
-    "Science": ["Physics", "Chemistry", "Biology", "Astronomy", "Earth Science"],
-    "History": ["Ancient History", "World Wars", "American History", "European History", "Asian History"],
-    "English": ["Grammar", "Literature", "Writing Skills", "Poetry", "Shakespeare"],
-    "Computer Science": ["Programming Basics", "Algorithms", "Web Development", "Data Science", "Artificial Intelligence"]
+    "Math": ("Algebra", "Geometry", "Calculus", "Statistics", "Trigonometry"),
+    "Science": ("Physics", "Chemistry", "Biology", "Astronomy", "Earth Science"),
+    "History": ("Ancient History", "World Wars", "American History", "European History", "Asian History"),
+    "English": ("Grammar", "Literature", "Writing Skills", "Poetry", "Shakespeare"),
+    "Computer Science": ("Programming Basics", "Algorithms", "Web Development", "Data Science", "Artificial Intelligence")
 }
+SUBJECT_NAMES = tuple(SUBJECTS)
 
-# --- Core Functions (from your original code, with slight modifications) ---
+LEVELS = ("Beginner", "Intermediate", "Advanced")
 
-# Use Streamlit's caching to avoid re-running the API call on every interaction
-@st.cache_data(show_spinner="Generating your lesson...")
-def generate_lesson(topic: str, level: str, subject: str) -> str:
-    """Generate a lesson on the given topic."""
-    if not model:
-        return "Model not initialized. Cannot generate lesson."
-    prompt = f"""
+# Prompt templates, filled in with str.format(topic=..., level=..., subject=...)
+LESSON_TEMPLATE = """
     Create a comprehensive lesson on {topic} for a {level} level student.
     Subject: {subject}
 
@@ -60,42 +77,253 @@ def generate_lesson(topic: str, level: str, subject: str) -> str:
     5) Common mistakes to avoid
 
     Keep it between 400-500 words and use clear, engaging language. Format the output using Markdown.
-    """
-    try:
-        response = model.generate_content(prompt)
-        return response.text
-    except Exception as e:
-        return f"An error occurred while generating the lesson: {e}"
+"""
 
-@st.cache_data(show_spinner="Creating your quiz...")
-def generate_quiz(topic: str, level: str, subject: str) -> dict:
-    """Generate a quiz on the given topic."""
-    if not model:
-        return {"questions": []} # Return empty quiz if model fails
-    prompt = f"""
+QUIZ_TEMPLATE = """
     Create a 5-question assessment on {topic} ({subject}) for {level} level students.
     Include multiple choice questions with 4 options each.
-    Format as a single, valid JSON object with a key "questions" which is a list of question objects.
-    Each question object must have these exact keys: "question", "options" (a list of 4 strings), "answer" (the correct string from options), and "explanation".
+    Each question object must have these exact keys: "question", "options" (a list of 4 strings), "answer" (the correct string copied exactly from options), and "explanation".
     Make questions progressively harder.
-    """
+"""
+
+# Response schema for quizzes. Gemini's JSON mode returns bare JSON in this
+# shape, so no fence stripping is needed; every key is required so the quiz
+# pages can index them directly. A response cut off at the token limit can
+# still fail to parse, which generate_quiz treats like any other error.
+QUIZ_QUESTION_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "question": {"type": "string"},
+        "options": {"type": "array", "items": {"type": "string"}},
+        "answer": {"type": "string"},
+        "explanation": {"type": "string"},
+    },
+    "required": ["question", "options", "answer", "explanation"],
+}
+
+QUIZ_SCHEMA = {
+    "type": "object",
+    "properties": {"questions": {"type": "array", "items": QUIZ_QUESTION_SCHEMA}},
+    "required": ["questions"],
+}
+
+QUIZ_CONFIG = genai.GenerationConfig(response_mime_type="application/json", response_schema=QUIZ_SCHEMA)
+
+# Shown in place of a quiz when generation fails; the question text is
+# filled in with the topic
+_FALLBACK_QUIZ = {
+    "questions": [
+        {
+            "question": "",
+            "options": ["N/A", "N/A", "N/A", "N/A"],
+            "answer": "N/A",
+            "explanation": "There was an error communicating with the AI model to generate the quiz."
+        }
+    ]
+}
+
+EMBEDDING_MODEL = "models/text-embedding-004"
+# Topics at least this similar (cosine) share cached lessons and quizzes
+SIMILARITY_THRESHOLD = 0.95
+# After an embedding error, similarity lookups are skipped for this many
+# seconds instead of paying for another failing round-trip per generation
+EMBED_RETRY_AFTER = 60
+
+# Generated lessons and quizzes are kept on disk for a week, so they survive
+# restarts and are shared by every process running from this directory
+CACHE_DIR = ".lesson_cache"
+CACHE_TTL = 7 * 24 * 60 * 60
+
+# --- Caching ---
+
+@st.cache_resource
+def disk_cache() -> diskcache.Cache:
+    """Return the persistent cache of generated lessons and quizzes."""
+    return diskcache.Cache(CACHE_DIR)
+
+def cache_key(kind: str, topic: str, level: str, subject: str) -> str:
+    """Return the disk cache key for a lesson or quiz."""
+    # Topics differing only in case share an entry
+    digest = hashlib.sha256(f"{topic.casefold()}|{level}|{subject}".encode()).hexdigest()
+    return f"{kind}:{digest}"
+
+# Exact keys only match the same (topic, level, subject), so "Newton's laws"
+# and "newtons law" would each cost a full generation. The semantic cache maps
+# a new topic onto one already taught at the same level and subject, and the
+# lesson and quiz for that topic are then both served from the disk cache.
+class SemanticCache:
+    """Previously taught topics looked up by embedding similarity."""
+
+    # Prefix of the disk entries holding (scope, embedding) for a topic
+    PREFIX = "topic:"
+
+    def __init__(self, threshold: float, store: diskcache.Cache):
+        self.threshold = threshold
+        self._store = store
+        self._lock = threading.Lock()
+        # (level, subject) -> (matrix of unit topic embeddings, topics)
+        self._entries = {}
+        # Reload the index saved by earlier processes, gathering each scope's
+        # rows first so its matrix is built with a single vstack
+        rows = {}
+        for name in store:
+            if isinstance(name, str) and name.startswith(self.PREFIX):
+                entry = store.get(name)
+                if entry is not None:
+                    scope, embedding = entry
+                    embeddings, topics = rows.setdefault(scope, ([], []))
+                    embeddings.append(embedding)
+                    topics.append(name[len(self.PREFIX):].split("|", 2)[2])
+        for scope, (embeddings, topics) in rows.items():
+            self._entries[scope] = (np.vstack(embeddings), topics)
+
+    def get(self, scope: tuple, embedding: np.ndarray) -> str | None:
+        """Return the closest topic in scope, if it is similar enough."""
+        with self._lock:
+            if scope not in self._entries:
+                return None
+            embeddings, topics = self._entries[scope]
+        scores = embeddings @ embedding
+        best = int(np.argmax(scores))
+        return topics[best] if scores[best] >= self.threshold else None
+
+    def add(self, scope: tuple, embedding: np.ndarray, topic: str) -> None:
+        """Index a topic by its embedding."""
+        self._insert(scope, embedding, topic)
+        self._store.set(self._name(scope, topic), (scope, embedding), expire=CACHE_TTL)
+
+    def discard(self, scope: tuple, topic: str) -> None:
+        """Forget a topic, e.g. once its cached lesson has expired."""
+        with self._lock:
+            embeddings, topics = self._entries.get(scope, (None, []))
+            if topic in topics:
+                i = topics.index(topic)
+                if len(topics) == 1:
+                    del self._entries[scope]
+                else:
+                    self._entries[scope] = (np.delete(embeddings, i, axis=0), topics[:i] + topics[i + 1:])
+        self._store.delete(self._name(scope, topic))
+
+    def _name(self, scope: tuple, topic: str) -> str:
+        level, subject = scope
+        return f"{self.PREFIX}{level}|{subject}|{topic}"
+
+    def _insert(self, scope: tuple, embedding: np.ndarray, topic: str) -> None:
+        with self._lock:
+            embeddings, topics = self._entries.get(scope, (np.empty((0, embedding.size), dtype=embedding.dtype), []))
+            self._entries[scope] = (np.vstack([embeddings, embedding]), topics + [topic])
+
+@st.cache_resource
+def semantic_cache() -> SemanticCache:
+    """Return the process-wide semantic cache."""
+    return SemanticCache(SIMILARITY_THRESHOLD, disk_cache())
+
+@st.cache_data(show_spinner=False)
+def embed_topic(topic: str) -> np.ndarray:
+    """Embed a topic as a unit vector."""
+    result = genai.embed_content(model=EMBEDDING_MODEL, content=topic, task_type="semantic_similarity")
+    embedding = np.asarray(result["embedding"], dtype=np.float32)
+    return embedding / np.linalg.norm(embedding)
+
+@st.cache_resource
+def embed_failures() -> dict:
+    """Return the shared record of the last embedding failure."""
+    return {"at": float("-inf")}
+
+def try_embed_topic(topic: str) -> np.ndarray | None:
+    """Embed a topic, or return None if embedding is currently failing."""
+    failures = embed_failures()
+    if time.monotonic() - failures["at"] < EMBED_RETRY_AFTER:
+        return None
     try:
-        response = model.generate_content(prompt)
-        # Clean up the response to ensure it's valid JSON
-        json_text = response.text.strip().replace("```json", "").replace("```", "")
-        return json.loads(json_text)
+        return embed_topic(topic)
     except Exception:
-         # Fallback in case of API or JSON parsing error
-        return {
-            "questions": [
-                {
-                    "question": f"Could not generate a quiz for {topic}. Please try again.",
-                    "options": ["N/A", "N/A", "N/A", "N/A"],
-                    "answer": "N/A",
-                    "explanation": "There was an error communicating with the AI model to generate the quiz."
-                }
-            ]
-        }
+        failures["at"] = time.monotonic()
+        return None
+
+def recall(kind: str, topic: str, level: str, subject: str):
+    """Return the cached lesson or quiz for this topic, if any."""
+    return disk_cache().get(cache_key(kind, topic, level, subject))
+
+def remember(kind: str, topic: str, level: str, subject: str, value) -> None:
+    """Save a generated lesson or quiz to the disk cache."""
+    disk_cache().set(cache_key(kind, topic, level, subject), value, expire=CACHE_TTL)
+
+# Costs one embedding round-trip when the exact lesson isn't cached, which is
+# far cheaper than the multi-second generation a similar topic saves
+def resolve_topic(topic: str, level: str, subject: str) -> str:
+    """Return the already taught topic this request matches, or topic itself."""
+    if cache_key("lesson", topic, level, subject) in disk_cache():
+        return topic
+    embedding = try_embed_topic(topic)
+    if embedding is None:
+        return topic
+    match = semantic_cache().get((level, subject), embedding)
+    if match is None:
+        return topic
+    if cache_key("lesson", match, level, subject) not in disk_cache():
+        # The matched lesson has expired, so forget the topic as well
+        semantic_cache().discard((level, subject), match)
+        return topic
+    return match
+
+def index_topic(topic: str, level: str, subject: str) -> None:
+    """Make a freshly taught topic available to resolve_topic()."""
+    embedding = try_embed_topic(topic)
+    if embedding is not None:
+        semantic_cache().add((level, subject), embedding, topic)
+
+# --- Core Functions (from your original code, with slight modifications) ---
+
+def normalize_topic(topic: str) -> str:
+    """Strip a topic and collapse runs of whitespace inside it."""
+    return " ".join(topic.split())
+
+def stream_lesson(topic: str, level: str, subject: str):
+    """Stream a lesson on the given topic, yielding text chunks as they arrive."""
+    if not model:
+        yield "Model not initialized. Cannot generate lesson."
+        return
+    prompt = LESSON_TEMPLATE.format(topic=topic, level=level, subject=subject)
+    for chunk in model.generate_content(prompt, stream=True):
+        yield chunk.text
+
+# The quiz is generated on a worker thread while the lesson streams, so it
+# can't draw its own spinner; the lesson page shows one if it has to wait.
+# Errors are raised rather than returned so @st.cache_data never caches a
+# failure; callers fall back to fallback_quiz() instead.
+@st.cache_data(show_spinner=False)
+def generate_quiz(topic: str, level: str, subject: str) -> dict:
+    """Generate a quiz on the given topic."""
+    if not model:
+        raise RuntimeError("Model not initialized. Cannot generate quiz.")
+    quiz = recall("quiz", topic, level, subject)
+    if quiz is not None:
+        return quiz
+    prompt = QUIZ_TEMPLATE.format(topic=topic, level=level, subject=subject)
+    response = model.generate_content(prompt, generation_config=QUIZ_CONFIG)
+    quiz = orjson.loads(response.text)
+    remember("quiz", topic, level, subject, quiz)
+    return quiz
+
+def fallback_quiz(topic: str) -> dict:
+    """Return the placeholder quiz shown when generation fails."""
+    question = _FALLBACK_QUIZ["questions"][0].copy()
+    question["question"] = f"Could not generate a quiz for {topic}. Please try again."
+    return {"questions": [question]}
+
+
+@st.cache_resource
+def executor() -> ThreadPoolExecutor:
+    """Return the shared thread pool for running API calls in the background."""
+    return ThreadPoolExecutor(max_workers=8)
+
+# Speculative work gets its own small pool so it never delays a quiz the
+# lesson page is waiting on
+@st.cache_resource
+def prefetch_executor() -> ThreadPoolExecutor:
+    """Return the thread pool for prefetching quizzes."""
+    return ThreadPoolExecutor(max_workers=2)
 
 
 # --- Streamlit UI Flow ---
@@ -110,40 +338,89 @@ if 'lesson_content' not in st.session_state:
     st.session_state.lesson_content = None
 if 'quiz_data' not in st.session_state:
     st.session_state.quiz_data = None
+if 'source_topic' not in st.session_state:
+    st.session_state.source_topic = None
 
 
 # -- Stage 1: Topic Selection --
-if st.session_state.stage == 'selection':
+@st.fragment
+def selection_stage():
+    """Let the user choose a subject, level and topic."""
     st.header("1. Choose Your Topic")
     
     # Create columns for a cleaner layout
     col1, col2 = st.columns(2)
     
     with col1:
-        subject = st.selectbox("Choose a subject:", list(SUBJECTS.keys()))
-        level = st.selectbox("Enter your level:", ["Beginner", "Intermediate", "Advanced"])
+        subject = st.selectbox("Choose a subject:", SUBJECT_NAMES)
+        level = st.selectbox("Enter your level:", LEVELS)
     
     with col2:
-        # Dynamically update topic options based on subject
-        topic_options = SUBJECTS[subject]
-        topic = st.text_input("What specific topic?", placeholder=f"e.g., {topic_options[0]}")
+        # Dynamically update the topic placeholder based on subject
+        topic = st.text_input("What specific topic?", placeholder=f"e.g., {SUBJECTS[subject][0]}")
 
     if st.button("Generate Lesson", type="primary"):
-        if topic and subject and level and model:
+        # Normalize before anything is cached or sent to the model
+        topic = normalize_topic(topic)
+        if level not in LEVELS:
+            st.error(f"Please choose one of these levels: {', '.join(LEVELS)}.")
+        elif topic and subject and model:
             st.session_state.subject = subject
             st.session_state.level = level
             st.session_state.topic = topic
-            st.session_state.lesson_content = generate_lesson(topic, level, subject)
-            st.session_state.quiz_data = generate_quiz(topic, level, subject)
+            # Both are generated on the lesson page
+            st.session_state.source_topic = None
+            st.session_state.lesson_content = None
+            st.session_state.quiz_data = None
             st.session_state.stage = 'lesson'
             st.rerun() # Rerun the script to move to the next stage
         else:
             st.warning("Please fill in all fields before generating a lesson.")
 
 # -- Stage 2: Display Lesson and Offer Quiz --
-if st.session_state.stage == 'lesson':
+@st.fragment
+def lesson_stage():
+    """Show the lesson and offer the quiz."""
     st.header(f"📚 Lesson: {st.session_state.topic}")
-    st.markdown(st.session_state.lesson_content)
+    if st.session_state.source_topic is None:
+        # The lesson and quiz both come from the same (possibly similar) topic
+        st.session_state.source_topic = resolve_topic(st.session_state.topic, st.session_state.level, st.session_state.subject)
+    key = (st.session_state.source_topic, st.session_state.level, st.session_state.subject)
+    if st.session_state.quiz_data is None:
+        # Build the quiz concurrently instead of after the lesson
+        quiz_future = executor().submit(generate_quiz, *key)
+    if st.session_state.lesson_content is None:
+        lesson = recall("lesson", *key)
+        if lesson is not None:
+            st.session_state.lesson_content = lesson
+            st.markdown(st.session_state.lesson_content)
+        else:
+            try:
+                # Render tokens as they arrive instead of waiting for the full lesson
+                st.session_state.lesson_content = st.write_stream(stream_lesson(*key))
+            except Exception as e:
+                st.session_state.lesson_content = f"An error occurred while generating the lesson: {e}"
+                st.markdown(st.session_state.lesson_content)
+            else:
+                remember("lesson", *key, st.session_state.lesson_content)
+                index_topic(*key)
+    else:
+        st.markdown(st.session_state.lesson_content)
+    if st.session_state.quiz_data is None:
+        with st.spinner("Creating your quiz..."):
+            try:
+                st.session_state.quiz_data = quiz_future.result()
+            except Exception:
+                # Fallback in case of API or JSON parsing error
+                st.session_state.quiz_data = fallback_quiz(st.session_state.topic)
+            else:
+                # While the user reads, warm the cache with the quiz one level
+                # up. This runs once per lesson, and not at all when the quiz
+                # just failed, so an outage isn't hit with extra calls. A failed
+                # prefetch is dropped; the quiz is retried if that level is picked.
+                next_level = LEVELS.index(st.session_state.level) + 1
+                if next_level < len(LEVELS):
+                    prefetch_executor().submit(generate_quiz, st.session_state.source_topic, LEVELS[next_level], st.session_state.subject)
     
     st.markdown("---")
     st.info("Read through the lesson. When you're ready, start the quiz to test your knowledge!")
@@ -161,43 +438,47 @@ if st.session_state.stage == 'lesson':
 
 
 # -- Stage 3: Administer Quiz --
-if st.session_state.stage == 'quiz':
-    st.header(f"📝 Quiz: {st.session_state.topic}")
-    quiz = st.session_state.quiz_data
+@st.fragment
+def quiz_stage():
+    """Administer the quiz."""
+    ss = st.session_state
+    st.header(f"📝 Quiz: {ss.topic}")
+    quiz = ss.quiz_data
     
     if not quiz or not quiz.get("questions"):
         st.error("Sorry, we couldn't load the quiz. Please go back and try generating the lesson again.")
         if st.button("Go Back"):
-            st.session_state.stage = 'selection'
+            ss.stage = 'selection'
             st.rerun()
     else:
+        questions = quiz["questions"]
         with st.form("quiz_form"):
             user_answers = []
-            for i, q in enumerate(quiz["questions"]):
-                options = q.get("options", [])
+            for i, q in enumerate(questions):
+                question, options = q["question"], q.get("options", [])
                 # Ensure options are presented in a consistent order
-                user_answer = st.radio(f"**Question {i+1}:** {q['question']}", options, key=f"q{i}")
+                user_answer = st.radio(f"**Question {i+1}:** {question}", options, key=f"q{i}")
                 user_answers.append(user_answer)
             
             submitted = st.form_submit_button("Submit Answers")
 
             if submitted:
-                score = 0
-                for i, q in enumerate(quiz["questions"]):
-                    if user_answers[i] == q["answer"]:
-                        score += 1
-                
-                st.session_state.score = score
-                st.session_state.user_answers = user_answers
-                st.session_state.stage = 'results'
+                score = sum(ua == q["answer"] for ua, q in zip(user_answers, questions))
+                ss.score = score
+                ss.user_answers = user_answers
+                ss.stage = 'results'
                 st.rerun()
 
 # -- Stage 4: Show Results --
-if st.session_state.stage == 'results':
+@st.fragment
+def results_stage():
+    """Show the score with an explanation for each question."""
+    ss = st.session_state
     st.header("📊 Quiz Results")
-    quiz = st.session_state.quiz_data
-    score = st.session_state.score
-    total_questions = len(quiz['questions'])
+    questions = ss.quiz_data["questions"]
+    user_answers = ss.user_answers
+    score = ss.score
+    total_questions = len(questions)
     percentage = (score / total_questions) * 100 if total_questions > 0 else 0
     
     # Display score with a progress bar
@@ -217,19 +498,30 @@ if st.session_state.stage == 'results':
     
     # Display detailed answers and explanations
     st.subheader("Review Your Answers")
-    for i, q in enumerate(quiz["questions"]):
-        user_ans = st.session_state.user_answers[i]
-        correct_ans = q["answer"]
+    correct_mask = [ua == q["answer"] for ua, q in zip(user_answers, questions)]
+    for i, (q, user_ans, is_correct) in enumerate(zip(questions, user_answers, correct_mask)):
+        question, correct_ans, explanation = q["question"], q["answer"], q["explanation"]
         
-        if user_ans == correct_ans:
-            st.markdown(f"**Question {i+1}:** {q['question']} - ✅ Correct!")
+        if is_correct:
+            st.markdown(f"**Question {i+1}:** {question} - ✅ Correct!")
         else:
-            st.markdown(f"**Question {i+1}:** {q['question']} - ❌ Incorrect")
+            st.markdown(f"**Question {i+1}:** {question} - ❌ Incorrect")
             st.markdown(f"&nbsp;&nbsp;&nbsp;*Your answer: {user_ans}*")
             st.markdown(f"&nbsp;&nbsp;&nbsp;*Correct answer: {correct_ans}*")
-        st.info(f"**Explanation:** {q['explanation']}", icon="💡")
+        st.info(f"**Explanation:** {explanation}", icon="💡")
         st.markdown("---")
         
     if st.button("Learn Another Topic"):
-        st.session_state.stage = 'selection'
+        ss.stage = 'selection'
         st.rerun()
+
+
+# Each stage is a fragment, so widget interactions inside it rerun only that
+# stage; st.rerun() still reruns the whole app when the stage changes
+STAGES = {
+    'selection': selection_stage,
+    'lesson': lesson_stage,
+    'quiz': quiz_stage,
+    'results': results_stage,
+}
+STAGES[st.session_state.stage]()